@@ -0,0 +1,52 @@
+# cython: language_level=3, boundscheck=False, wraparound=False, initializedcheck=False
+"""
+Ahead-of-time compiled FIFO matching kernel.
+
+Build it in place with ``python setup.py build_ext --inplace``. When the
+compiled module is importable, fifo_processor uses it instead of the Numba
+kernel, so there is no JIT compilation on start-up.
+"""
+import numpy as np
+from libc.stdint cimport int64_t
+
+
+def fifo_match_companies(const double[::1] buy_qty, const double[::1] sell_qty,
+                         const int64_t[::1] sell_boundaries,
+                         const int64_t[::1] buy_starts, const int64_t[::1] buy_ends,
+                         const int64_t[::1] sell_starts, const int64_t[::1] sell_ends):
+    """
+    Match sells against purchases in FIFO order, company by company.
+    
+    Same contract as fifo_processor.fifo_match_companies: company c owns
+    buy_qty[buy_starts[c]:buy_ends[c]] and sell_qty[sell_starts[c]:sell_ends[c]],
+    and sell_boundaries[k] is the number of its company's purchases already in
+    the queue when sell k happens.
+    
+    Returns:
+        Tuple of (remaining quantity per purchase, unmatched quantity per sell)
+    """
+    buy_remaining_arr = np.array(buy_qty, dtype=np.float64)
+    unmatched_arr = np.zeros(sell_qty.shape[0], dtype=np.float64)
+    cdef double[::1] buy_remaining = buy_remaining_arr
+    cdef double[::1] unmatched = unmatched_arr
+    cdef Py_ssize_t c, k, head, n
+    cdef double qty, take
+    
+    with nogil:
+        for c in range(buy_starts.shape[0]):
+            head = buy_starts[c]
+            for k in range(sell_starts[c], sell_ends[c]):
+                qty = sell_qty[k]
+                # Never walk past the company's own purchases, as slicing does in the Numba kernel
+                n = buy_starts[c] + sell_boundaries[k]
+                if n > buy_ends[c]:
+                    n = buy_ends[c]
+                while qty > 0 and head < n:
+                    take = buy_remaining[head] if buy_remaining[head] < qty else qty
+                    buy_remaining[head] -= take
+                    qty -= take
+                    if buy_remaining[head] == 0:
+                        head += 1
+                unmatched[k] = qty
+    
+    return buy_remaining_arr, unmatched_arr
@@ -1,8 +1,233 @@
+import csv
+import logging
+import os
 import pandas as pd
 import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pacsv
+import pyarrow.parquet as pq
 from datetime import datetime
 
-def process_trades_fifo(csv_file):
+# Column types applied while parsing the CSV. Quantities and prices are read as
+# text because broker exports may contain thousands separators, a currency sign
+# or placeholders such as '-'.
+TRADE_SCHEMA = {
+    'TradeDate': pa.string(),
+    'ScripName': pa.dictionary(pa.int32(), pa.string()),
+    'Segment': pa.dictionary(pa.int32(), pa.string()),
+    'Client Code': pa.string(),
+    'ClientCode': pa.string(),
+    'BuyQty': pa.string(),
+    'SellQty': pa.string(),
+    'BuyPrice': pa.string(),
+    'SellPrice': pa.string(),
+}
+
+# Version of the cleaning rules (TRADE_SCHEMA and clean_trade_batch); bump it whenever
+# they change so Parquet caches written by older code are rebuilt
+CLEANING_VERSION = 3
+
+# Parquet schema metadata field identifying the CSV and cleaning rules behind a cache
+CACHE_KEY_FIELD = b'fifo_trades_source'
+
+# Size in bytes of each block of the CSV parsed at a time
+CSV_BLOCK_SIZE = 8 << 20
+
+# Thousands separators and currency signs stripped from quantities and prices
+PRICE_JUNK_PATTERN = '[,₹]'
+
+# A plain decimal number, optionally signed and/or in exponent notation (matched after
+# trimming whitespace, as the cast to float does not accept it)
+NUMBER_PATTERN = r'^[-+]?(\d+\.?\d*|\.\d+)([eE][-+]?\d+)?$'
+
+# Prefer the ahead-of-time compiled kernel when it has been built
+# (python setup.py build_ext --inplace). Otherwise fall back to the Numba kernels,
+# which are only imported and compiled in that case.
+try:
+    from fifo_kernel import fifo_match_companies
+except ImportError:
+    from numba import njit, prange, float64, int64, types
+
+    # Kernel inputs are only read, so read-only arrays (e.g. from pandas) are accepted too
+    READONLY_FLOAT_ARRAY = types.Array(float64, 1, 'C', readonly=True)
+    READONLY_INT_ARRAY = types.Array(int64, 1, 'C', readonly=True)
+
+    @njit(types.Tuple((float64[:], float64[:]))(READONLY_FLOAT_ARRAY, READONLY_FLOAT_ARRAY, READONLY_INT_ARRAY),
+          cache=True)
+    def fifo_match(buy_qty, sell_qty, sell_boundaries):
+        """
+        Match sells against purchases in FIFO order.
+        
+        Args:
+            buy_qty: Quantity of each purchase, in queue order
+            sell_qty: Quantity of each sell, in trade order
+            sell_boundaries: For each sell, the number of purchases already in the
+                             queue when the sell happens (only those can be matched)
+        
+        Returns:
+            Tuple of (remaining quantity per purchase, unmatched quantity per sell)
+        """
+        buy_remaining = buy_qty.copy()
+        unmatched = np.zeros(sell_qty.shape[0])
+        head = 0
+        for k in range(sell_qty.shape[0]):
+            qty = sell_qty[k]
+            n = sell_boundaries[k]
+            while qty > 0 and head < n:
+                take = min(buy_remaining[head], qty)
+                buy_remaining[head] -= take
+                qty -= take
+                if buy_remaining[head] == 0:
+                    head += 1
+            unmatched[k] = qty
+        return buy_remaining, unmatched
+
+    @njit(types.Tuple((float64[:], float64[:]))(READONLY_FLOAT_ARRAY, READONLY_FLOAT_ARRAY, READONLY_INT_ARRAY,
+                                                READONLY_INT_ARRAY, READONLY_INT_ARRAY,
+                                                READONLY_INT_ARRAY, READONLY_INT_ARRAY),
+          parallel=True, cache=True)
+    def fifo_match_companies(buy_qty, sell_qty, sell_boundaries, buy_starts, buy_ends, sell_starts, sell_ends):
+        """
+        Run fifo_match for many companies in parallel.
+        
+        Purchases and sells of all companies are passed as flat arrays grouped by
+        company; company c owns buy_qty[buy_starts[c]:buy_ends[c]] and
+        sell_qty[sell_starts[c]:sell_ends[c]]. Companies are independent, so each
+        one is matched on its own thread.
+        
+        Args:
+            buy_qty: Quantity of each purchase, in queue order within each company
+            sell_qty: Quantity of each sell, in trade order within each company
+            sell_boundaries: For each sell, the number of its company's purchases
+                             already in the queue when the sell happens
+            buy_starts, buy_ends: Range of each company's purchases
+            sell_starts, sell_ends: Range of each company's sells
+        
+        Returns:
+            Tuple of (remaining quantity per purchase, unmatched quantity per sell).
+            Purchases outside every range keep their full quantity and sells outside
+            every range report 0 unmatched.
+        """
+        buy_remaining = buy_qty.copy()
+        unmatched = np.zeros(sell_qty.shape[0])
+        for c in prange(buy_starts.shape[0]):
+            b0, b1 = buy_starts[c], buy_ends[c]
+            s0, s1 = sell_starts[c], sell_ends[c]
+            remaining, left = fifo_match(buy_qty[b0:b1], sell_qty[s0:s1], sell_boundaries[s0:s1])
+            buy_remaining[b0:b1] = remaining
+            unmatched[s0:s1] = left
+        return buy_remaining, unmatched
+
+def clean_trade_batch(batch):
+    """
+    Convert one block of raw CSV rows into typed trade columns.
+    
+    Args:
+        batch: pyarrow RecordBatch read with TRADE_SCHEMA column types
+    
+    Returns:
+        RecordBatch with TradeDate as timestamp and quantity/price columns as float
+    """
+    columns = {name: batch.column(name) for name in batch.schema.names}
+    
+    # Convert date column to datetime with explicit dd/mm/yyyy format (invalid dates become NaT)
+    columns['TradeDate'] = pc.strptime(columns['TradeDate'], format='%d/%m/%Y', unit='ns', error_is_null=True)
+    
+    # Clean quantity and price columns - remove any non-numeric characters and convert
+    # (missing or unparseable values become 0)
+    for col in ['BuyQty', 'SellQty', 'BuyPrice', 'SellPrice']:
+        if col in columns:
+            values = pc.utf8_trim_whitespace(pc.replace_substring_regex(columns[col], PRICE_JUNK_PATTERN, ''))
+            values = pc.if_else(pc.match_substring_regex(values, NUMBER_PATTERN), values, None)
+            columns[col] = pc.fill_null(pc.cast(values, pa.float64()), 0.0)
+    
+    return pa.RecordBatch.from_pydict(columns)
+
+def read_trades_csv(csv_file):
+    """
+    Read a trade CSV and clean it into a typed DataFrame.
+    
+    The file is parsed in blocks of CSV_BLOCK_SIZE bytes and only the columns
+    listed in TRADE_SCHEMA are kept, so the raw text of the whole file is never
+    held in memory at once.
+    
+    Args:
+        csv_file: Path to the CSV file containing trade data
+    
+    Returns:
+        DataFrame with TradeDate as datetime and quantity/price columns as float
+    """
+    # Only the columns the FIFO processing uses are parsed at all
+    with open(csv_file, newline='', encoding='utf-8-sig') as f:
+        header = next(csv.reader(f), [])
+    include_columns = [col for col in TRADE_SCHEMA if col in header]
+    
+    # Read the CSV file block by block, typing the columns while parsing
+    print(f"Reading trade data from {csv_file}...")
+    reader = pacsv.open_csv(csv_file,
+                            read_options=pacsv.ReadOptions(block_size=CSV_BLOCK_SIZE),
+                            convert_options=pacsv.ConvertOptions(column_types=TRADE_SCHEMA,
+                                                                 include_columns=include_columns,
+                                                                 strings_can_be_null=True))
+    
+    # Data cleaning and preparation, one block at a time
+    print("Cleaning and preparing data...")
+    batches = [clean_trade_batch(batch) for batch in reader]
+    if not batches:
+        batches = [clean_trade_batch(pa.RecordBatch.from_pylist([], schema=reader.schema))]
+    
+    return pa.Table.from_batches(batches).to_pandas()
+
+def trade_cache_key(csv_file):
+    """
+    Identify the exact source a Parquet cache of csv_file is valid for.
+    
+    Args:
+        csv_file: Path to the CSV file containing trade data
+    
+    Returns:
+        Bytes combining CLEANING_VERSION with the file's modification time and size
+    """
+    st = os.stat(csv_file)
+    return f"v{CLEANING_VERSION} mtime_ns={st.st_mtime_ns} size={st.st_size}".encode()
+
+def write_trades_csv(df, csv_file, date_format='%d/%m/%Y'):
+    """
+    Write a DataFrame to CSV with Arrow's C++ writer.
+    
+    Datetime columns are formatted with date_format by Arrow as well, so no
+    cell is formatted in Python. Strings are always quoted and whole floats
+    are written without a trailing '.0' (10 rather than 10.0).
+    
+    Args:
+        df: DataFrame to write; its index is not written
+        csv_file: Path of the CSV file to create
+        date_format: strftime format for datetime columns
+    """
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    for i, field in enumerate(table.schema):
+        if pa.types.is_timestamp(field.type):
+            table = table.set_column(i, field.name, pc.strftime(table[i], format=date_format))
+    pacsv.write_csv(table, csv_file, write_options=pacsv.WriteOptions(include_header=True))
+
+def company_ranges(sorted_codes, n_companies):
+    """
+    Find each company's contiguous range in an array grouped by company code.
+    
+    Args:
+        sorted_codes: Company code of each element, in ascending order; -1 (no
+            company) may only appear first
+        n_companies: Number of companies
+    
+    Returns:
+        Tuple (starts, ends) so company c owns elements starts[c]:ends[c]
+    """
+    # Count per code shifted by one so the -1 elements take slot 0, ahead of company 0
+    offsets = np.bincount(sorted_codes + 1, minlength=n_companies + 1).cumsum()
+    return offsets[:-1], offsets[1:]
+
+def process_trades_fifo(csv_file, verbose=False, logger=None):
     """
     Process trade data using FIFO method to determine remaining purchases,
     preserving the original order of trades in the input file.
@@ -12,38 +237,71 @@ def process_trades_fifo(csv_file):
         csv_file: Path to the CSV file containing trade data with columns:
                  ClientCode, TradeDate, Segment, ScripName, BuyQty, BuyPrice,
                  BuyAmount, SellQty, SellPrice, SellAmount, OrderNo
+        verbose: If True, log every sell and aggregated purchase at DEBUG level
+        logger: Logger for the per-trade messages (defaults to this module's logger)
     
     Returns:
         DataFrame with remaining purchases after all sales are matched
+        (TradeDate is returned as datetime; format it when writing out)
     """
-    # Read the CSV file
-    print(f"Reading trade data from {csv_file}...")
-    df = pd.read_csv(csv_file)
+    log = logger or logging.getLogger(__name__)
     
-    # Data cleaning and preparation
-    print("Cleaning and preparing data...")
+    # Reuse the cleaned data from a previous run only if it was built from this exact
+    # CSV (same modification time and size) by the current cleaning rules
+    cache_file = f"{csv_file}.parquet"
+    cache_key = trade_cache_key(csv_file)
+    df = None
+    if os.path.exists(cache_file):
+        try:
+            if (pq.read_schema(cache_file).metadata or {}).get(CACHE_KEY_FIELD) == cache_key:
+                print(f"Reading cleaned trade data from {cache_file}...")
+                df = pq.read_table(cache_file).to_pandas()
+        except (OSError, pa.ArrowInvalid) as e:
+            print(f"Ignoring unreadable cache {cache_file}: {e}")
+    if df is None:
+        df = read_trades_csv(csv_file)
+        # Write to a temporary file first so an interrupted run never leaves a partial cache
+        partial_file = f"{csv_file}.{os.getpid()}.partial.parquet"
+        try:
+            table = pa.Table.from_pandas(df)
+            table = table.replace_schema_metadata({**table.schema.metadata, CACHE_KEY_FIELD: cache_key})
+            pq.write_table(table, partial_file, compression='snappy')
+            os.replace(partial_file, cache_file)
+        except OSError as e:
+            print(f"Could not cache cleaned data to {cache_file}: {e}")
+            if os.path.exists(partial_file):
+                os.remove(partial_file)
     
-    # Convert date column to datetime with explicit dd/mm/yyyy format
-    df['TradeDate'] = pd.to_datetime(df['TradeDate'], format='%d/%m/%Y', errors='coerce')
+    # Normalise the optional columns once so later steps can use them unconditionally:
+    # the client code may be exported as 'Client Code' (which takes precedence) or be
+    # missing, and a missing SellPrice counts as 0
+    if 'Client Code' in df.columns:
+        df = df.drop(columns='ClientCode', errors='ignore').rename(columns={'Client Code': 'ClientCode'})
+    elif 'ClientCode' not in df.columns:
+        df['ClientCode'] = ''
+    if 'SellPrice' not in df.columns:
+        df['SellPrice'] = 0.0
     
-    # Ensure numeric columns are properly typed
-    df['BuyQty'] = pd.to_numeric(df['BuyQty'], errors='coerce').fillna(0)
-    df['SellQty'] = pd.to_numeric(df['SellQty'], errors='coerce').fillna(0)
+    # Number the companies once (in order of first appearance) and order the rows by
+    # company, keeping the input order within each company
+    codes, companies = pd.factorize(df['ScripName'], sort=False)
+    order = np.argsort(codes, kind='stable')
     
-    # Clean price columns - remove any non-numeric characters and convert
-    for col in ['BuyPrice', 'SellPrice']:
-        if col in df.columns:
-            if df[col].dtype == object:  # If string type
-                df[col] = df[col].astype(str).str.replace(',', '').str.replace('₹', '')
-            df[col] = pd.to_numeric(df[col], errors='coerce').fillna(0)
+    # Trade dates as int64 nanoseconds: used for comparisons and as grouping keys,
+    # formatted only for messages
+    trade_dates = df['TradeDate'].to_numpy(dtype='datetime64[ns]')
+    trade_ns = trade_dates.view(np.int64)
     
-    # Check if data might not be chronologically sorted - better method that accounts for same dates
-    unsorted_companies = []
-    for company in df['ScripName'].unique():
-        company_df = df[df['ScripName'] == company]
-        # Check if dates are monotonically increasing (allows equal dates)
-        if not company_df['TradeDate'].is_monotonic_increasing:
-            unsorted_companies.append(company)
+    # Check if data might not be chronologically sorted - dates must be monotonically
+    # increasing within each company (allows equal dates) and known. With the rows in
+    # company order this is one comparison of each trade date with the previous one.
+    ordered_codes = codes[order]
+    ordered_ns = trade_ns[order]
+    goes_back = (ordered_ns[1:] < ordered_ns[:-1]) & (ordered_codes[1:] == ordered_codes[:-1])
+    bad_codes = np.concatenate([ordered_codes[1:][goes_back], codes[np.isnat(trade_dates)]])
+    is_sorted = np.ones(len(companies), dtype=bool)
+    is_sorted[bad_codes[bad_codes >= 0]] = False
+    unsorted_companies = [companies[c] for c in np.flatnonzero(~is_sorted)]
     
     if unsorted_companies:
         print("\nWARNING: The following companies have trades that are not in chronological order:")
@@ -51,171 +309,133 @@ def process_trades_fifo(csv_file):
             print(f"- {company}")
         print("These companies will be skipped during processing as FIFO method requires chronological order.")
     
-    # Initialize a list to store remaining purchases
-    remaining_purchases = []
-    
     # Process by company (ScripName)
-    companies = df['ScripName'].unique()
     print(f"Found {len(companies)} unique companies in the data")
     
     # Process only companies with sorted trades
-    companies_to_process = [c for c in companies if c not in unsorted_companies]
-    print(f"Processing {len(companies_to_process)} companies with chronologically ordered trades")
+    print(f"Processing {int(is_sorted.sum())} companies with chronologically ordered trades")
     
-    for company in companies_to_process:
-        print(f"\nProcessing trades for: {company}")
-        company_trades = df[df['ScripName'] == company]
-        
-        # Initialize queue for purchases
-        purchase_queue = []
-        
-        # Create a temporary dataframe to hold daily purchase data for aggregation
-        daily_buys = {}  # Dictionary to store buys by date
+    # Pull the columns out as plain NumPy arrays once
+    qty_buy = df['BuyQty'].to_numpy(dtype=np.float64)
+    qty_sell = df['SellQty'].to_numpy(dtype=np.float64)
+    price_sell = df['SellPrice'].to_numpy(dtype=np.float64)
+    
+    is_buy = qty_buy > 0
+    is_sell = ~is_buy & (qty_sell > 0)
+    
+    # Number of earlier sells of the same company for each trade. A sell moves every
+    # pending buy into the FIFO queue, so buys on the same day are only aggregated
+    # when no sell falls between them.
+    sells_before = pd.Series(is_sell.astype(np.int64)).groupby(codes).cumsum().to_numpy() - is_sell
+    
+    # Aggregate buys by company, period between sells and day in a single grouped pass.
+    # Sorting the keys orders purchases by company, then chronologically within each company.
+    buys = pd.DataFrame({
+        'Code': codes[is_buy],
+        'Period': sells_before[is_buy],
+        'Day': trade_ns[is_buy],
+        'Segment': df['Segment'].to_numpy(dtype=object)[is_buy],
+        'ClientCode': df['ClientCode'].to_numpy(dtype=object)[is_buy],
+        'BuyQty': qty_buy[is_buy],
+        'BuyAmount': qty_buy[is_buy] * df['BuyPrice'].to_numpy(dtype=np.float64)[is_buy],
+        'Last_Index': df.index.to_numpy(dtype=np.int64)[is_buy],
+    })
+    daily = buys.groupby(['Code', 'Period', 'Day'], sort=True, as_index=False).agg(
+        Segment=('Segment', 'first'),
+        ClientCode=('ClientCode', 'first'),
+        BuyQty=('BuyQty', 'sum'),
+        BuyAmount=('BuyAmount', 'sum'),
+        Last_Index=('Last_Index', 'max'),  # Last original index for sorting
+        NumTrades=('BuyQty', 'count'),
+    )
+    daily['AvgPrice'] = daily['BuyAmount'] / daily['BuyQty']
+    
+    # Purchase columns and each company's slice of them
+    lot_codes = daily['Code'].to_numpy()
+    lot_periods = daily['Period'].to_numpy()
+    lot_dates = daily['Day'].to_numpy(dtype=np.int64).view('datetime64[ns]')
+    lot_segments = daily['Segment'].to_numpy(dtype=object)
+    lot_clients = daily['ClientCode'].to_numpy(dtype=object)
+    lot_qty = daily['BuyQty'].to_numpy(dtype=np.float64)
+    lot_price = daily['AvgPrice'].to_numpy(dtype=np.float64)
+    lot_last_index = daily['Last_Index'].to_numpy()
+    lot_trades = daily['NumTrades'].to_numpy()
+    lot_starts, lot_ends = company_ranges(lot_codes, len(companies))
+    
+    # Sells of all companies, grouped by company and in trade order within each one
+    sell_rows = order[is_sell[order] & (codes[order] >= 0)]
+    sell_codes = codes[sell_rows]
+    sell_starts, sell_ends = company_ranges(sell_codes, len(companies))
+    
+    # For each sell, the number of its company's purchases already moved into the queue:
+    # every purchase from the periods up to and including that sell's one. Purchases are
+    # sorted by (company, period), so a single binary search per sell finds the boundary.
+    n_periods = int(sells_before.max(initial=0)) + 1
+    lot_keys = lot_codes * n_periods + lot_periods
+    sell_periods = np.arange(len(sell_rows)) - sell_starts[sell_codes]
+    sell_boundaries = (np.searchsorted(lot_keys, sell_codes * n_periods + sell_periods, side='right')
+                       - lot_starts[sell_codes])
+    
+    if verbose:
+        def log_purchase(j):
+            log.debug(f"  Added aggregated purchase: {lot_qty[j]} shares at avg price "
+                      f"{lot_price[j]:.2f} on {np.datetime_as_string(lot_dates[j], unit='D')} "
+                      f"({lot_trades[j]} trades)")
         
-        for _, trade in company_trades.iterrows():
-            trade_date = trade['TradeDate']
-            date_str = trade_date.strftime('%Y-%m-%d') if not pd.isna(trade_date) else 'Unknown'
+        for c, company in enumerate(companies):
+            if not is_sorted[c]:
+                continue
             
-            # Process buy transactions with daily aggregation
-            if trade['BuyQty'] > 0:
-                buy_qty = trade['BuyQty']
-                buy_price = trade['BuyPrice']
-                buy_amount = buy_qty * buy_price
-                
-                # Store the purchase by date for later aggregation
-                if date_str not in daily_buys:
-                    daily_buys[date_str] = {
-                        'TradeDate': trade_date,
-                        'ScripName': company,
-                        'Segment': trade['Segment'],
-                        'ClientCode': trade['Client Code'] if 'Client Code' in trade else trade.get('ClientCode', ''),
-                        'BuyQty': buy_qty,
-                        'BuyAmount': buy_amount,
-                        'Trades': [_],  # List of original indices
-                        'Last_Index': _  # Last original index for sorting
-                    }
-                else:
-                    # Add to existing date entry
-                    print("> ", end='')  # Indicate aggregation
-                    daily_buys[date_str]['BuyQty'] += buy_qty
-                    daily_buys[date_str]['BuyAmount'] += buy_amount
-                    daily_buys[date_str]['Trades'].append(_)
-                    daily_buys[date_str]['Last_Index'] = _  # Update to latest index
-                
-                print(f"  Buy: {buy_qty} shares at {buy_price} on {date_str}")
+            log.debug(f"Processing trades for: {company}")
             
-            # Process sell transactions 
-            elif trade['SellQty'] > 0:
-                # First, add any pending daily buys to the purchase queue
-                # but only for dates earlier than or equal to the current trade date
-                current_date_str = date_str
-                
-                dates_to_process = []
-                for date in sorted(daily_buys.keys()):
-                    if date <= current_date_str:
-                        dates_to_process.append(date)
-                
-                for date in dates_to_process:
-                    buy_data = daily_buys[date]
-                    avg_price = buy_data['BuyAmount'] / buy_data['BuyQty'] if buy_data['BuyQty'] > 0 else 0
-                    
-                    purchase_queue.append({
-                        'TradeDate': buy_data['TradeDate'],
-                        'ScripName': company,
-                        'Segment': buy_data['Segment'],
-                        'ClientCode': buy_data['ClientCode'],
-                        'BuyQty': buy_data['BuyQty'],
-                        'BuyPrice': avg_price,
-                        'OrderNo': f"Aggregated-{date}",  # Mark as aggregated
-                        'RemainingQty': buy_data['BuyQty'],
-                        'Original_Index': buy_data['Last_Index'],
-                        'AggregatedTrades': len(buy_data['Trades']),
-                        'TradeDates': date
-                    })
-                    
-                    print(f"  Added aggregated purchase: {buy_data['BuyQty']} shares at avg price {avg_price:.2f} on {date}")
-                    
-                    # Remove this date from daily_buys as it's now in the purchase queue
-                    del daily_buys[date]
-                
-                # Now process the sell
-                sell_qty = trade['SellQty']
-                sell_price = trade['SellPrice'] if 'SellPrice' in trade and not pd.isna(trade['SellPrice']) else 0
-                
-                print(f"  Sell: {sell_qty} shares at {sell_price} on {date_str}")
-                
-                # Match sales with purchases using FIFO
-                qty_to_sell = sell_qty
-                i = 0
-                
-                while qty_to_sell > 0 and i < len(purchase_queue):
-                    if purchase_queue[i]['RemainingQty'] <= qty_to_sell:
-                        # Use all remaining quantity from this purchase
-                        qty_used = purchase_queue[i]['RemainingQty']
-                        qty_to_sell -= qty_used
-                        purchase_queue[i]['RemainingQty'] = 0
-                        print(f"    Matched: {qty_used} shares from purchase on {purchase_queue[i]['TradeDates']}")
-                    else:
-                        # Use partial quantity from this purchase
-                        purchase_queue[i]['RemainingQty'] -= qty_to_sell
-                        print(f"    Matched: {qty_to_sell} shares from purchase on {purchase_queue[i]['TradeDates']}")
-                        qty_to_sell = 0
-                    
-                    i += 1
+            # Replay the queue: purchases are added just before the first sell that can use them
+            queued = lot_starts[c]
+            for k in range(sell_starts[c], sell_ends[c]):
+                for j in range(queued, lot_starts[c] + sell_boundaries[k]):
+                    log_purchase(j)
+                queued = max(queued, lot_starts[c] + sell_boundaries[k])
                 
-                if qty_to_sell > 0:
-                    print(f"  Warning: Could not match {qty_to_sell} shares for sale!")
-        
-        # Add any remaining daily buys to the purchase queue
-        for date, buy_data in sorted(daily_buys.items()):
-            avg_price = buy_data['BuyAmount'] / buy_data['BuyQty'] if buy_data['BuyQty'] > 0 else 0
-            
-            purchase_queue.append({
-                'TradeDate': buy_data['TradeDate'],
-                'ScripName': company,
-                'Segment': buy_data['Segment'],
-                'ClientCode': buy_data['ClientCode'],
-                'BuyQty': buy_data['BuyQty'],
-                'BuyPrice': avg_price,
-                'OrderNo': f"Aggregated-{date}",  # Mark as aggregated
-                'RemainingQty': buy_data['BuyQty'],
-                'Original_Index': buy_data['Last_Index'],
-                'AggregatedTrades': len(buy_data['Trades']),
-                'TradeDates': date
-            })
+                i = sell_rows[k]
+                log.debug(f"  Sell: {qty_sell[i]} shares at {price_sell[i]} on "
+                          f"{np.datetime_as_string(trade_dates[i], unit='D')}")
             
-            print(f"  Added aggregated purchase: {buy_data['BuyQty']} shares at avg price {avg_price:.2f} on {date}")
-        
-        # Add remaining purchases to the result
-        for purchase in purchase_queue:
-            if purchase['RemainingQty'] > 0:
-                remaining_purchases.append(purchase)
+            # Add any remaining daily buys to the purchase queue
+            for j in range(queued, lot_ends[c]):
+                log_purchase(j)
+    
+    # Match sales with purchases using FIFO, all companies at once and in parallel.
+    # Companies with unsorted trades get empty ranges so nothing of theirs is matched.
+    buy_remaining, unmatched = fifo_match_companies(lot_qty, qty_sell[sell_rows], sell_boundaries,
+                                                    lot_starts, np.where(is_sorted, lot_ends, lot_starts),
+                                                    sell_starts, np.where(is_sorted, sell_ends, sell_starts))
+    
+    for k in np.flatnonzero(unmatched > 0):
+        sell_date = np.datetime_as_string(trade_dates[sell_rows[k]], unit='D')
+        print(f"Warning: Could not match {unmatched[k]} shares of {companies[sell_codes[k]]} for sale on {sell_date}!")
+    
+    # Remaining purchases of the processed companies, back in input order
+    keep = np.flatnonzero((buy_remaining > 0) & np.isin(lot_codes, np.flatnonzero(is_sorted)))
+    keep = keep[np.argsort(lot_last_index[keep], kind='stable')]
     
     # Create DataFrame from remaining purchases
-    if remaining_purchases:
-        result_df = pd.DataFrame(remaining_purchases)
+    if len(keep):
+        remaining_dates = pd.DatetimeIndex(lot_dates[keep])
+        remaining_qty = buy_remaining[keep]
         
-        # Sort by original index to maintain input order
-        if 'Original_Index' in result_df.columns:
-            result_df = result_df.sort_values('Original_Index')
-            result_df = result_df.drop('Original_Index', axis=1)
-        
-        # Calculate the total cost of remaining shares
-        result_df['RemainingCost'] = result_df['RemainingQty'] * result_df['BuyPrice']
-        
-        # Format dates back to dd/mm/yyyy for output consistency
-        result_df['TradeDate'] = result_df['TradeDate'].dt.strftime('%d/%m/%Y')
-        
-        # Add column for number of aggregated trades if applicable
-        if 'AggregatedTrades' in result_df.columns:
-            result_df = result_df.rename(columns={'AggregatedTrades': 'NumTrades'})
-        else:
-            result_df['NumTrades'] = 1  # Default for non-aggregated trades
-        
-        # Reorder columns for better readability
-        columns = ['ScripName', 'Segment', 'TradeDate', 'BuyQty', 'BuyPrice', 'RemainingQty', 
-                   'RemainingCost', 'ClientCode', 'OrderNo', 'NumTrades']
-        result_df = result_df[columns]
+        # Gather every column straight from the purchase arrays in a single constructor call,
+        # in output order for better readability
+        result_df = pd.DataFrame({
+            'ScripName': np.asarray(companies, dtype=object)[lot_codes[keep]],
+            'Segment': lot_segments[keep],
+            'TradeDate': remaining_dates,
+            'BuyQty': lot_qty[keep],
+            'BuyPrice': lot_price[keep],
+            'RemainingQty': remaining_qty,
+            'RemainingCost': remaining_qty * lot_price[keep],  # Total cost of remaining shares
+            'ClientCode': lot_clients[keep],
+            'OrderNo': 'Aggregated-' + remaining_dates.strftime('%Y-%m-%d'),  # Mark as aggregated
+            'NumTrades': lot_trades[keep],  # Trades aggregated into each purchase
+        })
         
         print(f"\nTotal remaining purchases: {len(result_df)}")
         return result_df
@@ -233,15 +453,12 @@ def main():
     if not remaining_df.empty:
         # Save the result to a CSV file
         output_file = 'remaining_purchases.csv'
-        remaining_df.to_csv(output_file, index=False)
+        write_trades_csv(remaining_df, output_file)
         print(f"Remaining purchases saved to {output_file}")
         
         # Display a summary
         print("\nSummary of remaining purchases by company:")
         
-        # For the summary, convert TradeDate back to datetime
-        remaining_df['TradeDate'] = pd.to_datetime(remaining_df['TradeDate'], format='%d/%m/%Y', errors='coerce')
-        
         summary = remaining_df.groupby('ScripName').agg(
             Total_Remaining_Shares=('RemainingQty', 'sum'),
             Total_Remaining_Cost=('RemainingCost', 'sum'),
@@ -264,7 +481,7 @@ def main():
         
         # Save summary to a separate CSV
         summary_file = 'remaining_summary.csv'
-        summary.to_csv(summary_file)
+        write_trades_csv(summary.reset_index(), summary_file)
         print(f"Summary information saved to {summary_file}")
 
 if __name__ == "__main__":
@@ -0,0 +1,12 @@
+"""
+Builds the optional compiled FIFO kernel:
+
+    python setup.py build_ext --inplace
+"""
+from setuptools import setup
+from Cython.Build import cythonize
+
+setup(
+    name='fifo-trades-processing',
+    ext_modules=cythonize('fifo_kernel.pyx'),
+)
@@ -0,0 +1,141 @@
+import importlib
+import sys
+
+import numpy as np
+import pytest
+
+HEADER = 'TradeDate,ScripName,Segment,ClientCode,BuyQty,BuyPrice,SellQty,SellPrice\n'
+
+
+@pytest.fixture(params=['numba', 'cython'])
+def fifo(request, monkeypatch):
+    """fifo_processor freshly imported with the Numba or the compiled Cython kernel."""
+    if request.param == 'cython':
+        pytest.importorskip('fifo_kernel')
+    else:
+        # Hide any built extension so the Numba kernels are defined
+        monkeypatch.setitem(sys.modules, 'fifo_kernel', None)
+    monkeypatch.delitem(sys.modules, 'fifo_processor', raising=False)
+    module = importlib.import_module('fifo_processor')
+    expected = 'fifo_kernel' if request.param == 'cython' else 'fifo_processor'
+    assert module.fifo_match_companies.__module__ == expected
+    return module
+
+
+def write_trades(tmp_path, rows):
+    csv_file = tmp_path / 'trades.csv'
+    csv_file.write_text(HEADER + ''.join(row + '\n' for row in rows), encoding='utf-8')
+    return str(csv_file)
+
+
+def summarise(result):
+    """(ScripName, TradeDate, BuyQty, BuyPrice, RemainingQty, NumTrades) per remaining purchase."""
+    return list(zip(result['ScripName'], result['TradeDate'].dt.strftime('%d/%m/%Y'),
+                    result['BuyQty'], result['BuyPrice'], result['RemainingQty'], result['NumTrades']))
+
+
+def test_sell_between_same_day_buys_splits_lots(fifo, tmp_path):
+    csv_file = write_trades(tmp_path, [
+        '01/01/2022,A,CASH,C1,10,100,0,0',
+        '01/01/2022,A,CASH,C1,0,0,4,110',
+        '01/01/2022,A,CASH,C1,5,120,0,0',
+        '02/01/2022,A,CASH,C1,2,10,0,0',
+        '02/01/2022,A,CASH,C1,2,20,0,0',
+    ])
+    result = fifo.process_trades_fifo(csv_file)
+    assert summarise(result) == [
+        ('A', '01/01/2022', 10.0, 100.0, 6.0, 1),
+        ('A', '01/01/2022', 5.0, 120.0, 5.0, 1),
+        ('A', '02/01/2022', 4.0, 15.0, 4.0, 2),
+    ]
+    assert list(result['OrderNo']) == ['Aggregated-2022-01-01', 'Aggregated-2022-01-01',
+                                       'Aggregated-2022-01-02']
+    assert list(result['RemainingCost']) == [600.0, 600.0, 60.0]
+
+
+def test_sell_without_earlier_purchase_is_reported(fifo, tmp_path, capsys):
+    csv_file = write_trades(tmp_path, [
+        '01/01/2022,B,CASH,C1,0,0,5,100',
+        '02/01/2022,B,CASH,C1,10,100,0,0',
+        '03/01/2022,B,CASH,C1,0,0,4,100',
+    ])
+    result = fifo.process_trades_fifo(csv_file)
+    assert summarise(result) == [('B', '02/01/2022', 10.0, 100.0, 6.0, 1)]
+    assert 'Could not match 5.0 shares of B for sale on 2022-01-01' in capsys.readouterr().out
+
+
+def test_out_of_order_company_is_skipped(fifo, tmp_path, capsys):
+    csv_file = write_trades(tmp_path, [
+        '02/01/2022,C,CASH,C1,10,100,0,0',
+        '01/01/2022,C,CASH,C1,5,100,0,0',
+        '01/01/2022,D,CASH,C1,3,50,0,0',
+    ])
+    result = fifo.process_trades_fifo(csv_file)
+    assert summarise(result) == [('D', '01/01/2022', 3.0, 50.0, 3.0, 1)]
+    out = capsys.readouterr().out
+    assert 'not in chronological order:\n- C\n' in out
+    assert 'Processing 1 companies' in out
+
+
+def test_trade_without_date_marks_company_unsorted(fifo, tmp_path):
+    csv_file = write_trades(tmp_path, [
+        '01/01/2022,G,CASH,C1,10,100,0,0',
+        'not a date,G,CASH,C1,0,0,4,100',
+        '01/01/2022,H,CASH,C1,1,10,0,0',
+    ])
+    result = fifo.process_trades_fifo(csv_file)
+    assert summarise(result) == [('H', '01/01/2022', 1.0, 10.0, 1.0, 1)]
+
+
+def test_blank_scrip_name_rows_are_ignored(fifo, tmp_path, capsys):
+    csv_file = write_trades(tmp_path, [
+        '01/01/2022,E,CASH,C1,10,100,0,0',
+        '02/01/2022,,CASH,C1,7,1,0,0',
+        '03/01/2022,,CASH,C1,0,0,2,1',
+    ])
+    result = fifo.process_trades_fifo(csv_file)
+    assert summarise(result) == [('E', '01/01/2022', 10.0, 100.0, 10.0, 1)]
+    out = capsys.readouterr().out
+    assert 'not in chronological order' not in out
+    assert 'Could not match' not in out
+
+
+def test_header_only_file_gives_empty_result(fifo, tmp_path):
+    result = fifo.process_trades_fifo(write_trades(tmp_path, []))
+    assert result.empty
+
+
+def test_padded_and_malformed_numbers_are_cleaned(fifo, tmp_path):
+    csv_file = write_trades(tmp_path, [
+        '01/01/2022,F,CASH,C1, 10 ,₹ 50,0,0',
+        '02/01/2022,F,CASH,C1,"1,000", 20 ,0,0',
+        '03/01/2022,F,CASH,C1,-,5,abc,0',
+        '04/01/2022,F,CASH,C1,0,0, 4 ,₹ 60',
+    ])
+    result = fifo.process_trades_fifo(csv_file)
+    assert summarise(result) == [
+        ('F', '01/01/2022', 10.0, 50.0, 6.0, 1),
+        ('F', '02/01/2022', 1000.0, 20.0, 1000.0, 1),
+    ]
+
+
+def test_corrupt_cache_is_rebuilt(fifo, tmp_path, capsys):
+    csv_file = write_trades(tmp_path, ['01/01/2022,A,CASH,C1,10,100,0,0'])
+    (tmp_path / 'trades.csv.parquet').write_bytes(b'PAR1 truncated')
+    assert summarise(fifo.process_trades_fifo(csv_file)) == [('A', '01/01/2022', 10.0, 100.0, 10.0, 1)]
+    assert 'Ignoring unreadable cache' in capsys.readouterr().out
+
+    # The rebuilt cache is complete and used by the next run
+    assert summarise(fifo.process_trades_fifo(csv_file)) == [('A', '01/01/2022', 10.0, 100.0, 10.0, 1)]
+    assert 'Reading cleaned trade data from' in capsys.readouterr().out
+    assert sorted(p.name for p in tmp_path.iterdir()) == ['trades.csv', 'trades.csv.parquet']
+
+
+def test_kernel_stays_within_each_company(fifo):
+    # Company 0 owns purchase 0 and the sell, company 1 owns purchase 1. The sell's
+    # boundary overstates company 0's queue, which must not reach company 1's purchase.
+    remaining, unmatched = fifo.fifo_match_companies(
+        np.array([5.0, 5.0]), np.array([8.0]), np.array([2]),
+        np.array([0, 1]), np.array([1, 2]), np.array([0, 1]), np.array([1, 1]))
+    assert list(remaining) == [0.0, 5.0]
+    assert list(unmatched) == [3.0]